@@ -1,10 +1,24 @@
 import re
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from tqdm import tqdm
 from lib.run_query import run_query
+from lib.util import save_results, retry_backoff_sleep, results_store
 import openai
 import concurrent.futures
-import time
 
+RAW_RESULTS_PATH = './raw_results.json'
+USE_JUDGE_CACHE = True # Cache judge responses on disk, keyed by (prompt id, test model response, judge model) (default True)
+JUDGE_CACHE_DIR = './judge_cache'
+JUDGE_CACHE_TTL_DAYS = 30 # Cached judge responses older than this are ignored & overwritten
 N_THREADS = 1  # Parallellises the judge prompts (only relevant if COMBINE_CRITERIA == False)
+JUDGE_PIPELINE_WORKERS = 8  # Concurrent judge api calls in the pipelined creative writing path
+REMOTE_INFERENCE_ENGINES = ('openai', 'anthropic', 'mistralai', 'gemini')  # Engines where generation is an api call, so it can be parallelised alongside judging
+results_lock = threading.Lock()  # Guards the results dict when judge workers store concurrently
 openai_client_judge = None # Separate client for the openai judge because the test model openai client might be
                            # using a different openai-compatible url
 SKIP_ANALYSIS = False # Skips the "detailed analysis" part of the judge prompt (default False)
@@ -44,8 +58,8 @@ def process_criteria(criteria_set, writing_prompt, reference_output, test_model_
 				tries += 1
 		except Exception as e:
 			print(e)
-			time.sleep(30)
 			tries += 1
+			retry_backoff_sleep(tries, initial=5, max_delay=30)
 			#judge_temp += 0.2
 
 	if verbose:
@@ -53,98 +67,116 @@ def process_criteria(criteria_set, writing_prompt, reference_output, test_model_
 
 	return judge_model_response
 
-def process_writing_prompt(prompt_id, prompt_data, model_path, prompt_type, model, tokenizer, results, run_index, 
-								run_iter, verbose, n_prompt_attempts, inference_engine, ooba_instance, 
-								launch_ooba, ooba_request_timeout, openai_client, judge_params, test_model_output = None, judgemark_test_model = None):
-	global openai_client_judge, SKIP_ANALYSIS, COMBINE_CRITERIA, N_THREADS, CRITERIA_TO_IGNORE
-
-	if test_model_output:
-		TEST_TYPE = 'judgemark'
-	else:
-		TEST_TYPE = 'creative-writing'
+def init_judge_client(judge_params):
+	global openai_client_judge
+	if judge_params['judge_model_api'] == 'openai' and not openai_client_judge:
+		openai_client_judge = openai.OpenAI(
+			#base_url='https://api.together.xyz',
+			api_key=judge_params['judge_model_api_key'],
+		)
 
+def build_writing_prompt(prompt_data, run_iter):
 	combined_criteria = []
 	for criteria_set in prompt_data['judging_criteria']:
 		combined_criteria += criteria_set['criteria']
 	combined_criteria = list(reversed(combined_criteria))
 	filtered_criteria = [x for x in combined_criteria if x not in CRITERIA_TO_IGNORE]
-	
-	if judge_params['judge_model_api'] == 'openai' and not openai_client_judge:
-		openai_client_judge = openai.OpenAI(
-			#base_url='https://api.together.xyz',			
-			api_key=judge_params['judge_model_api_key'],
-		)
 
-	writing_prompt = "You are a talented creative writer of compelling, original prose.\n\n" 
+	writing_prompt = "You are a talented creative writer of compelling, original prose.\n\n"
 	if TEST_MODEL_SEES_CRITERIA:
 		writing_prompt += 'You are taking a creative writing test. These will be the assessment criteria to help direct your writing:\n' + '\n'.join(filtered_criteria) + '\n\n'
 	writing_prompt += prompt_data['writing_prompt']
-	judging_criteria = prompt_data['judging_criteria']
-	reference_output = prompt_data['reference_output']
 
 	# Add the seed to modify the writing prompt for this iteration
 	seed_index = (int(run_iter) - 1) % len(prompt_data['seed_modifiers'])
 	writing_prompt = writing_prompt.replace("<SEED>", prompt_data['seed_modifiers'][seed_index])
 
-	if verbose:
-		print(writing_prompt)
+	return writing_prompt, combined_criteria
+
+def generate_response(writing_prompt, model_path, prompt_type, model, tokenizer, inference_engine,
+							ooba_instance, launch_ooba, ooba_request_timeout, openai_client):
+	# Generate response from test model for creative writing benchmark
+	temp = 0.7
+	tries = 0
+	while tries <= 3:
+		tries += 1
+		this_writing_prompt = writing_prompt
+		if tries > 1:
+			this_writing_prompt += '\n\nDo not use language or themes that would get flagged by your content filter (Keep it PG-13).'
+		test_model_response = run_query(model_path, prompt_type, this_writing_prompt, [], 3000, model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client)
+
+		if test_model_response and len(test_model_response) >= 300:
+			return test_model_response
+
+		temp += 0.1
+		if temp > 1:
+			temp = 1
+		print(test_model_response)
+		print('! Missing or too short output from test model')
+		if tries <= 3:
+			print('retrying...')
+	return None
+
+def judge_cache_key(prompt_id, writing_prompt, test_model_response, judge_model):
+	# The seeded writing prompt is part of the key: it varies per iteration via
+	# the <SEED> modifier and is included in the judging prompt, so the same
+	# response judged under different seeds must not share a cache entry.
+	return hashlib.blake2s((str(prompt_id) + '|' + writing_prompt + '|' + test_model_response + '|' + str(judge_model)).encode()).hexdigest()
+
+def judge_cache_get(cache_key):
+	# Returns (scores, judge_model_responses) from the disk cache, or None on a
+	# miss. Entries past the ttl are treated as misses (and overwritten on the
+	# next store).
+	if not USE_JUDGE_CACHE:
+		return None
+	cache_path = os.path.join(JUDGE_CACHE_DIR, cache_key + '.json')
+	try:
+		if time.time() - os.path.getmtime(cache_path) > JUDGE_CACHE_TTL_DAYS * 86400:
+			return None
+		with open(cache_path, 'r') as f:
+			cached = json.load(f)
+		return cached['scores'], cached['judge_model_responses']
+	except (OSError, ValueError, KeyError):
+		return None
+
+def judge_cache_put(cache_key, scores, judge_model_responses):
+	if not USE_JUDGE_CACHE:
+		return
+	try:
+		os.makedirs(JUDGE_CACHE_DIR, exist_ok=True)
+		with open(os.path.join(JUDGE_CACHE_DIR, cache_key + '.json'), 'w') as f:
+			json.dump({'scores': scores, 'judge_model_responses': judge_model_responses}, f)
+	except OSError as e:
+		print('! Failed to write judge cache entry:', e)
+
+def score_response(prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response, verbose, judge_params):
+	"""
+	Run the judging process for a test model response.
+	Returns (scores, judge_model_responses); scores is None if judging failed.
+
+	Judge responses are cached on disk: the same judge model scoring the same
+	test model response for the same prompt is deterministic enough to reuse,
+	which elides the judge api calls entirely when re-running a benchmark after
+	scoring tweaks or resuming a sweep.
+	"""
+	reference_output = prompt_data['reference_output']
+	judging_criteria = prompt_data['judging_criteria']
+
+	cache_key = judge_cache_key(prompt_id, writing_prompt, test_model_response, judge_params['judge_model'])
+	cached = judge_cache_get(cache_key)
+	if cached:
+		if verbose:
+			print('Using cached judge response for prompt', prompt_id)
+		return cached
 
 	judging_tries = 0
-	judging_success = False
 	judge_temp = 0.01
-	while not judging_success and judging_tries <= 3:
+	while judging_tries <= 3:
 		judging_tries += 1
 		try:
-			if TEST_TYPE == 'creative-writing' and prompt_id in results[run_index]['iterations'][run_iter]['test_model_response'] and len(results[run_index]['iterations'][run_iter]['test_model_response'][prompt_id]) > 400:
-				# this is for when the test has been conducted manually somewhere and the test_model_response fields have been populated but require judging
-				test_model_output = results[run_index]['iterations'][run_iter]['test_model_response'][prompt_id]
-
-			# Generate response from test model	
-			test_generation_success = False
-			if test_model_output != None: # these are pregenerated if we are running judgemark
-				test_model_response = test_model_output
-				test_generation_success = True # automatic success!
-			else:		
-				temp = 0.7
-				tries = 0		
-				while not test_generation_success and tries <= 3:
-					tries += 1
-					this_writing_prompt = writing_prompt
-					if tries > 1:
-						this_writing_prompt += '\n\nDo not use language or themes that would get flagged by your content filter (Keep it PG-13).'
-					# Generate response from test model for creative writing benchmark
-					test_model_response = run_query(model_path, prompt_type, writing_prompt, [], 3000, model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client)
-	  				
-
-					if not test_model_response or len(test_model_response) < 300:				
-						temp += 0.1
-						if temp > 1:
-							temp = 1
-						print(test_model_response)
-						print('! Missing or too short output from test model')
-						if tries <= 5:
-							print('retrying...')
-						
-						continue
-					test_generation_success = True		
-						
-			if not test_model_response or len(test_model_response) < 300:
-				print(test_model_response)
-				print('! Failed to get output from test model')
-
-				return None
-
-			if verbose and TEST_TYPE != 'judgemark':
-				print(test_model_response)
-			
-			scores = {}
-			judge_model_responses = []
-			
-			
-				
 			scores = {}
 			judge_model_responses = []
-			
+
 			if COMBINE_CRITERIA:
 				judge_model_response = process_criteria({
 					'criteria': combined_criteria,
@@ -161,44 +193,187 @@ def process_writing_prompt(prompt_id, prompt_data, model_path, prompt_type, mode
 					print('! Failed to parse scores in judge response')
 					judge_temp += 0.2
 					continue
-				
+
 				scores.update(parse_scores(judge_model_response))
 				judge_model_responses.append(judge_model_response)
-				judging_success = True
 			else:
 				with concurrent.futures.ThreadPoolExecutor(max_workers=N_THREADS) as executor:
-					future_to_criteria = {executor.submit(process_criteria, criteria_set): criteria_set for criteria_set in judging_criteria}
+					future_to_criteria = {executor.submit(process_criteria, criteria_set, writing_prompt, reference_output, test_model_response, verbose, judge_params, judge_temp): criteria_set for criteria_set in judging_criteria}
 					for future in concurrent.futures.as_completed(future_to_criteria):
 						judge_model_response = future.result()
 						# gemini likes to add *'s as markdown formatting. we can safely strip these out.
 						judge_model_response = judge_model_response.replace('*','')
 						# other models (like wizardlm 8x22) like to add square brackets
 						judge_model_response = judge_model_response.replace('[','').replace(']', '')
-						scores.update(parse_scores(judge_model_response))			
+						scores.update(parse_scores(judge_model_response))
 						judge_model_responses.append(judge_model_response)
-				judging_success = True
 
+			judge_cache_put(cache_key, scores, judge_model_responses)
+			return scores, judge_model_responses
+
+		except KeyboardInterrupt:
+			raise  # Re-raising the KeyboardInterrupt exception
 		except Exception as e:
-			print(e)			
+			print(e)
+
+	return None, []
+
+def store_writing_prompt_result(results, run_index, run_iter, prompt_id, scores, test_model_response, judge_model_responses, judgemark_test_model = None):
+	# Store scores and responses in results dict
+	with results_lock:
+		iter_results = results[run_index]['iterations'][run_iter]
+		if judgemark_test_model:
+			iter_results = iter_results['judgemark_results'][judgemark_test_model]
+		iter_results['individual_scores'][prompt_id] = scores
+		iter_results['test_model_response'][prompt_id] = test_model_response
+		iter_results['judge_model_response'][prompt_id] = judge_model_responses
+		# In judgemark runs the same prompt is scored once per test model, so
+		# the model name has to be part of the flat-store key to keep the rows
+		# distinguishable.
+		if judgemark_test_model:
+			item_id = f'{judgemark_test_model}:{prompt_id}'
+		else:
+			item_id = prompt_id
+		for criteria, score in scores.items():
+			results_store.upsert(run_index, run_iter, item_id, criteria, score)
+
+def process_writing_prompt(prompt_id, prompt_data, model_path, prompt_type, model, tokenizer, results, run_index,
+								run_iter, verbose, n_prompt_attempts, inference_engine, ooba_instance,
+								launch_ooba, ooba_request_timeout, openai_client, judge_params, test_model_output = None, judgemark_test_model = None):
+	if test_model_output:
+		TEST_TYPE = 'judgemark'
+	else:
+		TEST_TYPE = 'creative-writing'
+
+	init_judge_client(judge_params)
+
+	writing_prompt, combined_criteria = build_writing_prompt(prompt_data, run_iter)
 
 	if verbose:
-		print_score(scores)
+		print(writing_prompt)
+
+	if TEST_TYPE == 'creative-writing' and prompt_id in results[run_index]['iterations'][run_iter]['test_model_response'] and len(results[run_index]['iterations'][run_iter]['test_model_response'][prompt_id]) > 400:
+		# this is for when the test has been conducted manually somewhere and the test_model_response fields have been populated but require judging
+		test_model_output = results[run_index]['iterations'][run_iter]['test_model_response'][prompt_id]
+
+	if test_model_output != None: # these are pregenerated if we are running judgemark
+		test_model_response = test_model_output
+	else:
+		test_model_response = generate_response(writing_prompt, model_path, prompt_type, model, tokenizer,
+												inference_engine, ooba_instance, launch_ooba,
+												ooba_request_timeout, openai_client)
 
-	if not judging_success:
+	if not test_model_response or len(test_model_response) < 300:
+		print(test_model_response)
+		print('! Failed to get output from test model')
+		return None
+
+	if verbose and TEST_TYPE != 'judgemark':
+		print(test_model_response)
+
+	scores, judge_model_responses = score_response(prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response, verbose, judge_params)
+
+	if scores == None:
 		return {}
-	
-	# Store scores and responses in results dict
-	if TEST_TYPE == 'creative-writing':
-		results[run_index]['iterations'][run_iter]['individual_scores'][prompt_id] = scores
-		results[run_index]['iterations'][run_iter]['test_model_response'][prompt_id] = test_model_response
-		results[run_index]['iterations'][run_iter]['judge_model_response'][prompt_id] = judge_model_responses
-	elif TEST_TYPE == 'judgemark':
-		results[run_index]['iterations'][run_iter]['judgemark_results'][judgemark_test_model]['individual_scores'][prompt_id] = scores
-		results[run_index]['iterations'][run_iter]['judgemark_results'][judgemark_test_model]['test_model_response'][prompt_id] = test_model_response
-		results[run_index]['iterations'][run_iter]['judgemark_results'][judgemark_test_model]['judge_model_response'][prompt_id] = judge_model_responses
+
+	if verbose:
+		print_score(scores)
+
+	store_writing_prompt_result(results, run_index, run_iter, prompt_id, scores, test_model_response, judge_model_responses, judgemark_test_model)
 
 	return scores
 
+def process_writing_prompts_pipelined(questions, model_path, prompt_type, model, tokenizer, results, run_index,
+											run_iter, verbose, n_prompt_attempts, inference_engine, ooba_instance,
+											launch_ooba, ooba_request_timeout, openai_client, judge_params):
+	"""
+	Run the creative writing benchmark as a two-stage pipeline: the test model
+	generates responses sequentially while a pool of judge workers scores the
+	completed responses concurrently, so the generation of prompt N+1 overlaps
+	with the (network-bound) judging of prompt N.
+
+	When the test model itself is served over a remote api (openai-compatible,
+	anthropic etc.) there is no local gpu to keep saturated, so generation is
+	parallelised too: each prompt's full generate -> judge -> store sequence
+	runs as its own worker job.
+	"""
+	init_judge_client(judge_params)
+
+	completed = set(results[run_index]['iterations'][run_iter]['individual_scores'])
+	pending = [(prompt_id, prompt_data) for prompt_id, prompt_data in questions.items() if prompt_id not in completed]
+	if verbose and len(pending) < len(questions):
+		print(len(questions) - len(pending), 'prompts already complete')
+
+	def generate_for_prompt(prompt_id, prompt_data):
+		# Returns (writing_prompt, combined_criteria, test_model_response), or None on failure.
+		writing_prompt, combined_criteria = build_writing_prompt(prompt_data, run_iter)
+		if verbose:
+			print(writing_prompt)
+
+		existing_response = results[run_index]['iterations'][run_iter]['test_model_response'].get(prompt_id)
+		if existing_response and len(existing_response) > 400:
+			# this is for when the test has been conducted manually somewhere and the test_model_response fields have been populated but require judging
+			test_model_response = existing_response
+		else:
+			test_model_response = generate_response(writing_prompt, model_path, prompt_type, model, tokenizer,
+													inference_engine, ooba_instance, launch_ooba,
+													ooba_request_timeout, openai_client)
+
+		if not test_model_response or len(test_model_response) < 300:
+			print(test_model_response)
+			print('! Failed to get output from test model')
+			return None
+
+		if verbose:
+			print(test_model_response)
+
+		return writing_prompt, combined_criteria, test_model_response
+
+	def judge_and_store(prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response):
+		scores, judge_model_responses = score_response(prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response, verbose, judge_params)
+		if scores == None:
+			return {}
+		store_writing_prompt_result(results, run_index, run_iter, prompt_id, scores, test_model_response, judge_model_responses)
+		with results_lock:
+			save_results(results, RAW_RESULTS_PATH)
+		return scores
+
+	def generate_judge_and_store(prompt_id, prompt_data):
+		generated = generate_for_prompt(prompt_id, prompt_data)
+		if generated == None:
+			return {}
+		writing_prompt, combined_criteria, test_model_response = generated
+		return judge_and_store(prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=JUDGE_PIPELINE_WORKERS) as executor:
+		futures = []
+		if inference_engine in REMOTE_INFERENCE_ENGINES:
+			# Remote test model: no local gpu to serialise on, so generation +
+			# judging for each prompt runs as one fully parallel job.
+			for prompt_id, prompt_data in pending:
+				futures.append(executor.submit(generate_judge_and_store, prompt_id, prompt_data))
+			for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), mininterval=1.0, smoothing=0.05, disable=not sys.stderr.isatty()):
+				scores = future.result()
+				if scores:
+					if verbose:
+						print_score(scores)
+						print(scores)
+		else:
+			for prompt_id, prompt_data in tqdm(pending, mininterval=1.0, smoothing=0.05, disable=not sys.stderr.isatty()):
+				generated = generate_for_prompt(prompt_id, prompt_data)
+				if generated == None:
+					continue
+				writing_prompt, combined_criteria, test_model_response = generated
+
+				futures.append(executor.submit(judge_and_store, prompt_id, prompt_data, writing_prompt, combined_criteria, test_model_response))
+
+			for future in concurrent.futures.as_completed(futures):
+				scores = future.result()
+				if scores:
+					if verbose:
+						print_score(scores)
+						print(scores)
+
 def parse_scores(judge_model_response):
 	scores = {}
 	
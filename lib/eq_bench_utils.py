@@ -1,13 +1,145 @@
-import json
-from lib.scoring import calculate_score, calculate_score_fullscale, parse_answers, parse_answers_de
+import sys
+from tqdm import tqdm
+from lib.scoring import calculate_all_scores, parse_answers, parse_answers_de
 from lib.run_bench_helper_functions import remove_revision_instructions
-from lib.run_query import run_query
+from lib.run_query import run_query, run_query_batch, count_tokens_batch
+from lib.util import save_results, retry_backoff_sleep, results_store, gpu_cleanup
 
 COMPLETION_TOKENS = 60
 RAW_RESULTS_PATH = './raw_results.json'
+BATCH_SIZE = 16 # Number of pending questions submitted to the inference engine per batch
 
-def process_question(question_id, q, model_path, prompt_type, model, tokenizer, results, run_index, 
-							run_iter, verbose, n_question_attempts, inference_engine, ooba_instance, 
+def prepare_question_prompt(q, eqbench_version, language, REVISE):
+	prompt = q['prompt']
+	if eqbench_version == 'v2' and not REVISE:
+		prompt = remove_revision_instructions(prompt, language)
+	return prompt
+
+def parse_inference(inference, q, eqbench_version, language, REVISE):
+	"""
+	Parse an inference and calculate its scores against the reference answer.
+	Returns (parsed_answers, this_result, this_result_fullscale). Scores are
+	None when the respective answers could not be parsed.
+	"""
+	ref = q['reference_answer']
+	if 'reference_answer_fullscale' in q:
+		ref_fullscale = q['reference_answer_fullscale']
+	else:
+		ref_fullscale = None
+
+	if language == "de":
+		first_pass_answers, revised_answers = parse_answers_de(inference, REVISE)
+	else:
+		first_pass_answers, revised_answers = parse_answers(inference, REVISE)
+
+	parsed_answers = {
+					'first_pass': first_pass_answers,
+					'revised': revised_answers
+				}
+
+	this_result, this_result_fullscale = calculate_all_scores(ref, ref_fullscale, first_pass_answers, revised_answers, REVISE)
+
+	return parsed_answers, this_result, this_result_fullscale
+
+def store_question_result(results, run_index, run_iter, question_id, parsed_answers, this_result, this_result_fullscale, inference):
+	iter_results = results[run_index]['iterations'][run_iter]
+	iter_results['respondent_answers'][question_id] = parsed_answers
+	iter_results['individual_scores'][question_id] = this_result
+	iter_results['individual_scores_fullscale'][question_id] = this_result_fullscale
+	iter_results['raw_inference'][question_id] = inference
+	results_store.upsert(run_index, run_iter, question_id, 'first_pass_score', this_result['first_pass_score'])
+	results_store.upsert(run_index, run_iter, question_id, 'revised_score', this_result['revised_score'])
+	results_store.upsert(run_index, run_iter, question_id, 'first_pass_score_fullscale', this_result_fullscale['first_pass_score'])
+	results_store.upsert(run_index, run_iter, question_id, 'revised_score_fullscale', this_result_fullscale['revised_score'])
+
+def print_question_score(this_result, this_result_fullscale, eqbench_version, REVISE):
+	if eqbench_version == 'v1':
+		print('first pass:', round(this_result['first_pass_score'], 1))
+		if REVISE:
+			print('revised:', round(this_result['revised_score'], 1))
+	elif eqbench_version == 'v2':
+		if this_result_fullscale['first_pass_score'] != None:
+			print('first pass:', round(this_result_fullscale['first_pass_score'], 1))
+			if REVISE and this_result_fullscale['revised_score'] != None:
+				print('revised:', round(this_result_fullscale['revised_score'], 1))
+
+def process_questions_batched(questions, model_path, prompt_type, model, tokenizer, results, run_index,
+								run_iter, verbose, n_question_attempts, inference_engine, ooba_instance,
+								launch_ooba, ooba_request_timeout, openai_client, eqbench_version, language,
+								REVISE):
+	"""
+	Process the question set in batches of BATCH_SIZE. A first pass submits all
+	not-yet-completed questions through run_query_batch at low temperature; any
+	question whose answers fail to parse falls back to the sequential retry
+	path in process_question.
+	"""
+	# Snapshot the completed question ids into a set up front so the resume
+	# check is a single O(1) membership test per question rather than a chain
+	# of nested dict lookups.
+	completed = set(results[run_index]['iterations'][run_iter]['individual_scores'])
+	pending = [(question_id, q, prepare_question_prompt(q, eqbench_version, language, REVISE))
+				for question_id, q in questions.items() if question_id not in completed]
+	if verbose and len(pending) < len(questions):
+		print(len(questions) - len(pending), 'questions already complete')
+
+	# Sort pending questions by prompt length (longest first) so that each
+	# batch groups similar-length prompts. Since batches are only padded to
+	# their own longest member this minimizes wasted padding tokens.
+	# The question ids travel with the prompts, so results are still written
+	# back to the correct question.
+	if pending and inference_engine == 'transformers' and tokenizer:
+		token_counts = count_tokens_batch(tokenizer, [prompt for _, _, prompt in pending])
+		pending = [item for _, item in sorted(zip(token_counts, pending), key=lambda x: -x[0])]
+	else:
+		pending.sort(key=lambda item: -len(item[2]))
+
+	failed = []
+	temp = 0.01 # Low temp is important for consistency of results
+	# Cap progress bar refreshes at 1Hz and disable it entirely when output
+	# isn't a terminal, so per-update overhead and CI log spam stay negligible.
+	with tqdm(total=len(pending), mininterval=1.0, smoothing=0.05, disable=not sys.stderr.isatty()) as progress_bar:
+		for batch_start in range(0, len(pending), BATCH_SIZE):
+			batch = pending[batch_start:batch_start + BATCH_SIZE]
+			inferences = run_query_batch(model_path, prompt_type, [prompt for _, _, prompt in batch],
+										COMPLETION_TOKENS, model, tokenizer, temp, inference_engine,
+										ooba_instance, launch_ooba, ooba_request_timeout, openai_client)
+
+			for (question_id, q, prompt), inference in zip(batch, inferences):
+				success = False
+				if inference:
+					try:
+						if verbose:
+							print('\n'+inference)
+							print('________________')
+						parsed_answers, this_result, this_result_fullscale = parse_inference(inference, q, eqbench_version, language, REVISE)
+						if this_result['first_pass_score'] != None and (not REVISE or this_result['revised_score'] != None):
+							store_question_result(results, run_index, run_iter, question_id, parsed_answers, this_result, this_result_fullscale, inference)
+							if verbose:
+								print_question_score(this_result, this_result_fullscale, eqbench_version, REVISE)
+							success = True
+					except KeyboardInterrupt:
+						raise  # Re-raising the KeyboardInterrupt exception
+					except Exception as e:
+						print(e)
+				if not success:
+					failed.append((question_id, q))
+				progress_bar.update(1)
+
+			save_results(results, RAW_RESULTS_PATH)
+			if inference_engine == 'transformers':
+				# Between batches only: empty_cache() syncs the device, so doing
+				# this per question would cost more than it saves.
+				gpu_cleanup()
+
+	# Retry unparseable questions one at a time with the usual temperature bumps.
+	for question_id, q in failed:
+		process_question(question_id, q, model_path, prompt_type, model, tokenizer, results, run_index,
+						run_iter, verbose, n_question_attempts, inference_engine, ooba_instance,
+						launch_ooba, ooba_request_timeout, openai_client, eqbench_version, language,
+						REVISE)
+
+def process_question(question_id, q, model_path, prompt_type, model, tokenizer, results, run_index,
+							run_iter, verbose, n_question_attempts, inference_engine, ooba_instance,
 							launch_ooba, ooba_request_timeout, openai_client, eqbench_version, language,
 							REVISE):
 	"""
@@ -27,15 +159,7 @@ def process_question(question_id, q, model_path, prompt_type, model, tokenizer,
 	:return: Updated results.
 	"""
 
-	prompt = q['prompt']
-	ref = q['reference_answer']
-	if 'reference_answer_fullscale' in q:
-		ref_fullscale = q['reference_answer_fullscale']
-	else:
-		ref_fullscale = None
-
-	if eqbench_version == 'v2' and not REVISE:
-		prompt = remove_revision_instructions(prompt, language)
+	prompt = prepare_question_prompt(q, eqbench_version, language, REVISE)
 
 	tries = 0
 	success = False
@@ -48,47 +172,16 @@ def process_question(question_id, q, model_path, prompt_type, model, tokenizer,
 		inference = run_query(model_path, prompt_type, prompt, [], COMPLETION_TOKENS, model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client)
 
 		try:
-			if verbose:				
-				print('\n'+inference)				
+			if verbose:
+				print('\n'+inference)
 				print('________________')
 
 			# Parse and calculate scores for this question
 
-			if language == "de":
-				first_pass_answers, revised_answers = parse_answers_de(inference, REVISE)
-			else:
-				first_pass_answers, revised_answers = parse_answers(inference, REVISE)
-				
-			parsed_answers = {
-							'first_pass': first_pass_answers,
-							'revised': revised_answers
-						}
-
-			first_pass_score = calculate_score(ref, first_pass_answers)
-			if REVISE:
-				revised_score = calculate_score(ref, revised_answers)
-			else:
-				revised_score = None
-			this_result = {
-				'first_pass_score': first_pass_score,
-				'revised_score': revised_score
-			}
-			
-			if ref_fullscale:
-				first_pass_score_fullscale = calculate_score_fullscale(ref_fullscale, first_pass_answers)
-				if REVISE:
-					revised_score_fullscale = calculate_score_fullscale(ref_fullscale, revised_answers)
-				else:
-					revised_score_fullscale = None
-				this_result_fullscale = {
-					'first_pass_score': first_pass_score_fullscale,
-					'revised_score': revised_score_fullscale
-				}
-			else:
-				this_result_fullscale = {
-					'first_pass_score': None,
-					'revised_score': None
-				}
+			parsed_answers, this_result, this_result_fullscale = parse_inference(inference, q, eqbench_version, language, REVISE)
+
+			first_pass_score = this_result['first_pass_score']
+			revised_score = this_result['revised_score']
 
 			# Check if scores were parsed & calculated
 			if first_pass_score == None or (REVISE and revised_score == None):
@@ -99,28 +192,17 @@ def process_question(question_id, q, model_path, prompt_type, model, tokenizer,
 						prev_result_inference = inference
 						prev_result_parsed_answers = dict(parsed_answers)
 				raise Exception("Failed to parse scores")
-			
+
 			# Store in results dict
-			results[run_index]['iterations'][run_iter]['respondent_answers'][question_id] = parsed_answers
-			results[run_index]['iterations'][run_iter]['individual_scores'][question_id] = this_result
-			results[run_index]['iterations'][run_iter]['individual_scores_fullscale'][question_id] = this_result_fullscale
-			results[run_index]['iterations'][run_iter]['raw_inference'][question_id] = inference
+			store_question_result(results, run_index, run_iter, question_id, parsed_answers, this_result, this_result_fullscale, inference)
 			if verbose:
-				if eqbench_version == 'v1':
-					print('first pass:', round(first_pass_score, 1))
-					if REVISE:
-						print('revised:', round(revised_score, 1))
-				elif eqbench_version == 'v2':
-					if ref_fullscale:
-						print('first pass:', round(first_pass_score_fullscale, 1))
-						if REVISE:
-							print('revised:', round(revised_score_fullscale, 1))
+				print_question_score(this_result, this_result_fullscale, eqbench_version, REVISE)
 
 			success = True
 		except KeyboardInterrupt:
 			raise  # Re-raising the KeyboardInterrupt exception
 		except Exception as e:
-			print(e)				
+			print(e)
 			tries += 1
 
 			# Increase temp before trying again for a parseable result
@@ -128,12 +210,9 @@ def process_question(question_id, q, model_path, prompt_type, model, tokenizer,
 
 			if tries < n_question_attempts:
 				print('Retrying...')
+				retry_backoff_sleep(tries)
 			elif prev_result:
 				# We are out of retries and we have a partial result, so store it in the results dict
-				results[run_index]['iterations'][run_iter]['respondent_answers'][question_id] = prev_result_parsed_answers
-				results[run_index]['iterations'][run_iter]['individual_scores'][question_id] = prev_result
-				results[run_index]['iterations'][run_iter]['individual_scores_fullscale'][question_id] = prev_result_fullscale
-				results[run_index]['iterations'][run_iter]['raw_inference'][question_id] = prev_result_inference
+				store_question_result(results, run_index, run_iter, question_id, prev_result_parsed_answers, prev_result, prev_result_fullscale, prev_result_inference)
 
-	with open(RAW_RESULTS_PATH, 'w') as f:
-		json.dump(results, f)
\ No newline at end of file
+	save_results(results, RAW_RESULTS_PATH)
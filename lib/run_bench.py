@@ -2,14 +2,16 @@ import re
 import os
 import time
 import json
+import hashlib
 import datetime
 from tqdm import tqdm
 from lib.load_model import load_model
-from lib.eq_bench_utils import process_question
-from lib.creative_writing_utils import process_writing_prompt
+from lib.eq_bench_utils import process_question, process_questions_batched
+from lib.creative_writing_utils import process_writing_prompt, process_writing_prompts_pipelined
 from lib.scoring import calculate_eq_bench_score, calculate_creative_writing_score
 from lib.db import save_eq_bench_result_to_db, save_creative_writing_result_to_db, save_judgemark_result_to_db
-from lib.util import upload_results_google_sheets, delete_symlinks_and_dir
+from lib.util import upload_results_google_sheets, delete_symlinks_and_dir, save_results, load_json_file, load_json_file_cached, results_store, gpu_cleanup
+from lib.run_query import release_vllm_instances
 from lib.run_bench_helper_functions import format_include_exclude_string, fix_results, validate_and_extract_vars, run_test_prompts, remove_revision_instructions
 from lib.judgemark import compute_judgemark_results
 import lib.ooba
@@ -19,47 +21,55 @@ RAW_RESULTS_PATH = './raw_results.json'
 BENCH_RESULTS_PATH = './benchmark_results.csv'
 
 
+def hash_run_index(run_label):
+	# The run label concatenates up to 10 fields (model paths, ooba cli params, ...)
+	# and can easily run to hundreds of chars. It is used as a dict key in every
+	# completion check and results write, so we hash it down to a short fixed-width
+	# key. blake2s at 12 bytes (24 hex chars) is fast and collision risk is
+	# negligible at this scale. The readable label is kept in run_metadata.
+	# ! Note: this changes the top-level keys in raw_results.json, so --resume
+	# won't pick up runs started before this change.
+	return hashlib.blake2s(run_label.encode(), digest_size=12).hexdigest()
+
+
 def setup_benchmark(benchmark_type, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, language, judge_params, questions_fn):
 	if benchmark_type == 'eq-bench':
-		with open(questions_fn, 'r') as f:
-			questions = json.load(f)
+		questions = load_json_file_cached(questions_fn)
 		process_fn = process_question
 		scoring_fn = calculate_eq_bench_score
 		save_result_to_db_fn = save_eq_bench_result_to_db
 		eqbench_version = "v1" if len(questions) == 60 else "v2"
-		run_index = f"{run_id}--{eqbench_version}--{language}--{model_path}--{lora_path}--{prompt_type}--{quantization}--{inference_engine}--{ooba_params}--{format_include_exclude_string(include_patterns, exclude_patterns)}"
+		run_label = f"{run_id}--{eqbench_version}--{language}--{model_path}--{lora_path}--{prompt_type}--{quantization}--{inference_engine}--{ooba_params}--{format_include_exclude_string(include_patterns, exclude_patterns)}"
 
 	elif benchmark_type == 'creative-writing':
-		with open('data/creative_writing_prompts.json', 'r') as f:
-			questions = json.load(f)
+		questions = load_json_file_cached('data/creative_writing_prompts.json')
 		process_fn = process_writing_prompt
 		scoring_fn = calculate_creative_writing_score
 		save_result_to_db_fn = save_creative_writing_result_to_db
-		run_index = f"{run_id}--creative-writing--{model_path}--{lora_path}--{prompt_type}--{quantization}--{inference_engine}--{ooba_params}--{format_include_exclude_string(include_patterns, exclude_patterns)}"
+		run_label = f"{run_id}--creative-writing--{model_path}--{lora_path}--{prompt_type}--{quantization}--{inference_engine}--{ooba_params}--{format_include_exclude_string(include_patterns, exclude_patterns)}"
 		eqbench_version = None
 
 	elif benchmark_type == 'judgemark':
-		with open('data/judgemark_test_set.json', 'r') as f:
-			test_model_outputs = json.load(f)
-		with open('data/creative_writing_prompts.json', 'r') as f:
-			questions = json.load(f)
+		test_model_outputs = load_json_file_cached('data/judgemark_test_set.json')
+		questions = load_json_file_cached('data/creative_writing_prompts.json')
 		process_fn = process_writing_prompt
 		scoring_fn = calculate_creative_writing_score
 		save_result_to_db_fn = save_judgemark_result_to_db
-		run_index = f"{run_id}--judgemark--{judge_params['judge_model']}"
+		run_label = f"{run_id}--judgemark--{judge_params['judge_model']}"
 		eqbench_version = None
 		
 	else:
 		raise ValueError(f"Invalid benchmark type: {benchmark_type}")
-		
-	return questions, process_fn, scoring_fn, save_result_to_db_fn, run_index, eqbench_version, test_model_outputs if benchmark_type == 'judgemark' else None
 
+	run_index = hash_run_index(run_label)
 
-def initialize_results(run_index, benchmark_type, resume, n_iterations, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, judge_params, language, eqbench_version):
+	return questions, process_fn, scoring_fn, save_result_to_db_fn, run_index, run_label, eqbench_version, test_model_outputs if benchmark_type == 'judgemark' else None
+
+
+def initialize_results(run_index, run_label, benchmark_type, resume, n_iterations, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, judge_params, language, eqbench_version):
 	results = {}
 	if resume and os.path.exists(RAW_RESULTS_PATH):
-		with open(RAW_RESULTS_PATH, 'r') as f:
-			results = json.load(f)
+		results = load_json_file(RAW_RESULTS_PATH)
 		if benchmark_type == 'eq-bench':
 			results = fix_results(results)
 
@@ -67,6 +77,7 @@ def initialize_results(run_index, benchmark_type, resume, n_iterations, run_id,
 		results[run_index] = {
 			'run_metadata': {
 					"run_id": run_id,
+					"run_label": run_label,
 					"benchmark_type": benchmark_type,
 					"total_iterations": n_iterations,
 					"inference_engine": inference_engine,
@@ -157,14 +168,16 @@ def process_questions(benchmark_type, model, ooba_instance, inference_engine, re
 			print('Test model:', model_name)
 			print('########################')
 			model_scores = []
-			if model_name not in results[run_index]['iterations'][run_iter]['judgemark_results']:
-				results[run_index]['iterations'][run_iter]['judgemark_results'][model_name] = {
+			judgemark_results = results[run_index]['iterations'][run_iter]['judgemark_results']
+			if model_name not in judgemark_results:
+				judgemark_results[model_name] = {
 						'individual_scores': {},
 						'test_model_response': {},
 						'judge_model_response': {}
-				}							
-			for prompt_id, test_model_response in model_outputs.items():									
-				if verbose and prompt_id in results[run_index]['iterations'][run_iter]['judgemark_results'][model_name]['individual_scores']:
+				}
+			completed = set(judgemark_results[model_name]['individual_scores'])
+			for prompt_id, test_model_response in model_outputs.items():
+				if verbose and prompt_id in completed:
 					print('Prompt',prompt_id, 'already completed')
 					continue
 				prompt_data = questions[prompt_id]
@@ -173,28 +186,18 @@ def process_questions(benchmark_type, model, ooba_instance, inference_engine, re
 												launch_ooba, ooba_request_timeout, openai_client, judge_params,
 												test_model_response, model_name)
 				model_scores.append(scores)
-				with open(RAW_RESULTS_PATH, 'w') as f:
-					json.dump(results, f)
+				save_results(results, RAW_RESULTS_PATH)
 
-	else:
-		for question_id, q in tqdm(questions.items()):			
-			if question_id in results[run_index]['iterations'][run_iter]['individual_scores']:
-				if verbose:
-					print(f"Question {question_id} already complete")
-			else:
-				if benchmark_type == 'eq-bench':
-					process_fn(question_id, q, model_path, prompt_type, model, tokenizer, results, run_index, run_iter, verbose,
-									n_attempts, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client, eqbench_version,
-									language, REVISE)
-				elif benchmark_type == 'creative-writing':
-					scores = process_fn(question_id, q, model_path, prompt_type, model, tokenizer, results, run_index,
-													run_iter, verbose, n_attempts, inference_engine, ooba_instance, launch_ooba,
-													ooba_request_timeout, openai_client, judge_params)
-					if scores:
-						if verbose:
-							print(scores)
-						with open(RAW_RESULTS_PATH, 'w') as f:
-							json.dump(results, f)
+	elif benchmark_type == 'eq-bench':
+		process_questions_batched(questions, model_path, prompt_type, model, tokenizer, results, run_index,
+								run_iter, verbose, n_attempts, inference_engine, ooba_instance, launch_ooba,
+								ooba_request_timeout, openai_client, eqbench_version, language, REVISE)
+
+	elif benchmark_type == 'creative-writing':
+		process_writing_prompts_pipelined(questions, model_path, prompt_type, model, tokenizer, results, run_index,
+										run_iter, verbose, n_attempts, inference_engine, ooba_instance, launch_ooba,
+										ooba_request_timeout, openai_client, judge_params)
+		save_results(results, RAW_RESULTS_PATH, force=True)
 
 
 def save_and_upload_results(run_id, formatted_datetime, bench_success, prompt_type, model_path, lora_path, quantization, benchmark_type, lang_suffix, this_score, parseable, n_iterations, inference_engine, ooba_params, include_patterns, exclude_patterns, judge_params, results, run_index, last_error, bench_tries, max_bench_retries, google_spreadsheet_url, save_result_to_db_fn, eqbench_version):
@@ -289,10 +292,16 @@ def save_and_upload_results(run_id, formatted_datetime, bench_success, prompt_ty
 
 	save_result_to_db_fn(results[run_index], this_score, parseable if benchmark_type == 'eq-bench' else 'N/A', last_error, run_index, bench_success)
 
+	results_store.export()
+
 
 def cleanup(model, tokenizer, inference_engine, launch_ooba, ooba_instance, delete_model_files, model_path, include_patterns, exclude_patterns, models_to_delete, models_remaining, verbose):
-	del model 
+	del model
 	del tokenizer
+	if inference_engine == 'vllm':
+		# Free the engine's preallocated vram so the next model in the sweep
+		# can bring up its own engine.
+		release_vllm_instances()
 	if inference_engine == 'ooba' and launch_ooba:
 		try:
 			ooba_instance.stop()
@@ -331,9 +340,9 @@ def run_generic_benchmark(run_id, model_path, lora_path, prompt_type, quantizati
 										questions_fn=None, openai_client=None, language='en',
 										REVISE=False, benchmark_type='eq-bench', judge_params={}):
 
-	questions, process_fn, scoring_fn, save_result_to_db_fn, run_index, eqbench_version, test_model_outputs = setup_benchmark(benchmark_type, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, language, judge_params, questions_fn)
+	questions, process_fn, scoring_fn, save_result_to_db_fn, run_index, run_label, eqbench_version, test_model_outputs = setup_benchmark(benchmark_type, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, language, judge_params, questions_fn)
 
-	results = initialize_results(run_index, benchmark_type, resume, n_iterations, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, judge_params, language, eqbench_version)
+	results = initialize_results(run_index, run_label, benchmark_type, resume, n_iterations, run_id, model_path, lora_path, prompt_type, quantization, inference_engine, ooba_params, include_patterns, exclude_patterns, judge_params, language, eqbench_version)
 
 	initialize_iterations(results, run_index, n_iterations, benchmark_type, resume)
 
@@ -369,6 +378,11 @@ def run_generic_benchmark(run_id, model_path, lora_path, prompt_type, quantizati
 				if benchmark_type == 'judgemark':
 					compute_judgemark_results(results, run_index, test_model_outputs, verbose)
 
+				if inference_engine == 'transformers':
+					# Release cached vram between iterations so long runs keep
+					# stable memory headroom.
+					gpu_cleanup()
+
 				bench_success = True
 			except Exception as e:  
 						print(e)
@@ -411,8 +425,7 @@ def run_generic_benchmark(run_id, model_path, lora_path, prompt_type, quantizati
 			this_score = scoring_fn(run_index, results, RAW_RESULTS_PATH)  
 			print('Creative Writing Score:', this_score)
 			print('Judge:', judge_params['judge_model'])
-			with open(RAW_RESULTS_PATH, 'w') as f:
-						json.dump(results, f)
+			save_results(results, RAW_RESULTS_PATH, force=True)
 
 		elif benchmark_type == 'judgemark':
 			print('Judge:', judge_params['judge_model'])
@@ -420,8 +433,7 @@ def run_generic_benchmark(run_id, model_path, lora_path, prompt_type, quantizati
 			print('Mean Score:', round(results[run_index]['judgemark_results']['mean_score'], 2))
 			print('Std. Dev.:', round(results[run_index]['judgemark_results']['std_dev'], 2))
 			print('Judgemark Score:', round(results[run_index]['judgemark_results']['extended_metrics']['Judgemark'], 2))
-			with open(RAW_RESULTS_PATH, 'w') as f:
-				json.dump(results, f)
+			save_results(results, RAW_RESULTS_PATH, force=True)
 
 	if not bench_success:
 		print(f"! {benchmark_type} Benchmark Failed")
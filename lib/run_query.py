@@ -1,4 +1,6 @@
 from transformers import pipeline
+import torch
+import concurrent.futures
 import time
 import yaml
 import requests
@@ -8,25 +10,59 @@ import google.generativeai as genai
 anthropic_client = None
 gemini_model = None
 
+# Max number of worker threads used to fan out batched queries to api-backed engines
+BATCH_QUERY_MAX_THREADS = 16
+
+# Cache of tokenized prompts, keyed by (tokenizer name_or_path, prompt).
+# Retries and repeat iterations re-run the same prompt, so there's no need to
+# re-tokenize it every time. The question set is small so the cache is a few
+# MB at most; it's cleared on each model load so it doesn't accumulate over a
+# config sweep.
+_tokenized_prompt_cache = {}
+
+def clear_tokenized_prompt_cache():
+	_tokenized_prompt_cache.clear()
+
+def count_tokens_batch(tokenizer, prompts):
+	# Token counts for a list of prompts in one call, used for length-sorted
+	# batching. Fast (rust-backed) tokenizers expose encode_batch, which
+	# releases the GIL and tokenizes all prompts on its internal thread pool;
+	# slow tokenizers fall back to a single batched __call__.
+	if hasattr(tokenizer, 'backend_tokenizer') and hasattr(tokenizer.backend_tokenizer, 'encode_batch'):
+		return [len(encoding.ids) for encoding in tokenizer.backend_tokenizer.encode_batch(prompts)]
+	return [len(ids) for ids in tokenizer(prompts, add_special_tokens=True)['input_ids']]
+
+def encode_prompt(tokenizer, prompt, add_special_tokens=True):
+	# Keyed by name_or_path rather than id(): tokenizer objects are released
+	# between models in a sweep and a recycled address would silently serve the
+	# previous model's token ids.
+	cache_key = (getattr(tokenizer, 'name_or_path', None) or id(tokenizer), prompt, add_special_tokens)
+	if cache_key not in _tokenized_prompt_cache:
+		_tokenized_prompt_cache[cache_key] = tokenizer.encode(prompt, add_special_tokens=add_special_tokens, return_tensors="pt")
+	return _tokenized_prompt_cache[cache_key]
+
 def run_chat_template_query(prompt, completion_tokens, model, tokenizer, temp):
 	chat = [
     { "role": "user", "content": prompt },
 	]
 	prompt = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
-	inputs = tokenizer.encode(prompt, add_special_tokens=True, return_tensors="pt")
-	outputs = model.generate(input_ids=inputs.to(model.device), max_new_tokens=completion_tokens, temperature=temp, do_sample=True)
+	inputs = encode_prompt(tokenizer, prompt)
+	with torch.inference_mode():
+		outputs = model.generate(input_ids=inputs.to(model.device), max_new_tokens=completion_tokens, temperature=temp, do_sample=True)
 	output = tokenizer.decode(outputs[0], skip_special_tokens=True)
 	# Trim off the prompt
 	trimmed_output = output[len(prompt):].strip()	
 	return trimmed_output
 
 def run_chat_query(prompt, completion_tokens, model, tokenizer, temp):
-	response, history = model.chat(tokenizer, prompt, history=None, max_new_tokens=completion_tokens, do_sample=True)
+	with torch.inference_mode():
+		response, history = model.chat(tokenizer, prompt, history=None, max_new_tokens=completion_tokens, do_sample=True)
 	return response
 
 def run_pipeline_query(prompt, completion_tokens, model, tokenizer, temp):
 	text_gen = pipeline(task="text-generation", model=model, tokenizer=tokenizer, do_sample=True, temperature=temp, max_new_tokens=completion_tokens)
-	output = text_gen(prompt)
+	with torch.inference_mode():
+		output = text_gen(prompt)
 	out_str = output[0]['generated_text']
 	# Trim off the prompt
 	if type(out_str) == str:
@@ -52,21 +88,23 @@ def run_llama3_query(prompt, completion_tokens, model, tokenizer, temp):
 		tokenizer.convert_tokens_to_ids("<|eot_id|>")
 	]
 
-	outputs =text_gen(
-		prompt,
-		max_new_tokens=completion_tokens,
-		eos_token_id=terminators,
-		do_sample=True,
-		temperature=temp,
-	)
+	with torch.inference_mode():
+		outputs = text_gen(
+			prompt,
+			max_new_tokens=completion_tokens,
+			eos_token_id=terminators,
+			do_sample=True,
+			temperature=temp,
+		)
 
 	trimmed_output = outputs[0]["generated_text"][len(prompt):].strip()
 
 	return trimmed_output
 
 def run_generate_query(prompt, completion_tokens, model, tokenizer, temp):
-	inputs = tokenizer(prompt, return_tensors="pt")
-	outputs = model.generate(inputs.input_ids, max_new_tokens=completion_tokens, do_sample=True, temperature=temp)
+	input_ids = encode_prompt(tokenizer, prompt)
+	with torch.inference_mode():
+		outputs = model.generate(input_ids, max_new_tokens=completion_tokens, do_sample=True, temperature=temp)
 	output = tokenizer.decode(outputs[0], skip_special_tokens=True)
 	# Trim off the prompt
 	trimmed_output = output[len(prompt):].strip()
@@ -85,6 +123,49 @@ OPENSOURCE_MODELS_INFERENCE_METHODS = {
 	'meta-llama/Meta-Llama-3-8B-Instruct': run_llama3_query,
 }
 
+# Lazily-instantiated vLLM engine, keyed by model path. vLLM loads the model
+# itself (separately from lib.load_model). At most one engine is kept alive:
+# each engine preallocates most of the vram (gpu_memory_utilization), so a
+# second engine in a multi-model sweep would OOM on init.
+vllm_instances = {}
+
+VLLM_MAX_NUM_BATCHED_TOKENS = 2048 # Per-step token budget when chunked prefill is enabled
+
+def release_vllm_instances():
+	# Drop any live engine and return its vram to the pool so the next model's
+	# engine can preallocate.
+	if vllm_instances:
+		vllm_instances.clear()
+		from lib.util import gpu_cleanup
+		gpu_cleanup()
+
+def get_vllm_instance(model_path):
+	if model_path not in vllm_instances:
+		try:
+			from vllm import LLM
+		except ImportError:
+			raise Exception("vllm is not installed. Install it with: pip install -r requirements-vllm.txt")
+		release_vllm_instances()
+		# Chunked prefill splits long prompt prefills into pieces that are
+		# scheduled alongside decode steps, so the compute-bound prefill of one
+		# request doesn't stall the memory-bound decoding of the others. This
+		# mainly helps the creative writing bench, whose 1-2k token prompts are
+		# followed by long decodes.
+		vllm_instances[model_path] = LLM(model=model_path, dtype='bfloat16', gpu_memory_utilization=0.9,
+											enable_chunked_prefill=True,
+											max_num_batched_tokens=VLLM_MAX_NUM_BATCHED_TOKENS)
+	return vllm_instances[model_path]
+
+def run_vllm_query(prompts, prompt_format, completion_tokens, temp, model_path):
+	# vLLM schedules requests internally with continuous batching, so we hand
+	# it the whole list of prompts in a single generate call.
+	from vllm import SamplingParams
+	llm = get_vllm_instance(model_path)
+	formatted_prompts = [generate_prompt_from_template(prompt, prompt_format) for prompt in prompts]
+	sampling_params = SamplingParams(temperature=temp, max_tokens=completion_tokens)
+	outputs = llm.generate(formatted_prompts, sampling_params)
+	return [output.outputs[0].text.strip() for output in outputs]
+
 def run_llamacpp_query(prompt, prompt_format, completion_tokens, temp):
 	# Generate the prompt from the template
 	formatted_prompt = generate_prompt_from_template(prompt, prompt_format)		
@@ -388,9 +469,75 @@ def generate_prompt_from_template(prompt, prompt_type):
 	formatted_prompt = formatted_prompt.split("<|bot-message|>")[0]
 	return formatted_prompt.replace("<|user-message|>", prompt)
 
+def run_transformers_batch_query(prompts, completion_tokens, model, tokenizer, temp, add_special_tokens=True):
+	# Tokenize the whole batch in one call, padding each prompt to the longest
+	# member of the batch, then decode all completions from a single generate call.
+	padding_side = tokenizer.padding_side
+	tokenizer.padding_side = "left" # causal LMs must be left-padded for batched generation
+	try:
+		inputs = tokenizer(prompts, padding=True, add_special_tokens=add_special_tokens, return_tensors="pt").to(model.device)
+	finally:
+		tokenizer.padding_side = padding_side
+
+	# At very low temperatures greedy decoding is equivalent and more stable.
+	do_sample = temp >= 0.02
+	gen_kwargs = {
+		'max_new_tokens': completion_tokens,
+		'do_sample': do_sample
+	}
+	if do_sample:
+		gen_kwargs['temperature'] = temp
+	with torch.inference_mode():
+		outputs = model.generate(**inputs, **gen_kwargs)
+
+	# Trim off the (padded) prompts
+	completions = tokenizer.batch_decode(outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+	return [completion.strip() for completion in completions]
+
+def run_query_batch(model_path, prompt_format, prompts, completion_tokens, model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client, api_key = None):
+	"""
+	Run a batch of prompts through the inference engine in one go.
+	For the transformers engine the prompts are submitted as a single padded
+	batch through model.generate; for api-backed engines the requests are
+	fanned out over a thread pool so they overlap on the network.
+	Returns a list of inferences in the same order as the supplied prompts.
+	"""
+	if inference_engine == 'vllm':
+		return run_vllm_query(prompts, prompt_format, completion_tokens, temp, model_path)
+	elif inference_engine == 'transformers' and model_path not in OPENSOURCE_MODELS_INFERENCE_METHODS:
+		formatted_prompts = []
+		for prompt in prompts:
+			if prompt_format:
+				formatted_prompts.append(generate_prompt_from_template(prompt, prompt_format))
+			else:
+				chat = [
+					{"role": "system", "content": "You are an expert in emotional intelligence."},
+					{"role": "user", "content": prompt},
+				]
+				formatted_prompts.append(tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True))
+		# Chat-templated strings already embed any BOS/special tokens the template
+		# defines, so don't re-add them when tokenizing; this keeps the batch
+		# encoding identical to the sequential pipeline() path used for retries.
+		return run_transformers_batch_query(formatted_prompts, completion_tokens, model, tokenizer, temp,
+											add_special_tokens=bool(prompt_format))
+	elif inference_engine == 'transformers':
+		# Models with a custom inference method don't support batched generation,
+		# so fall back to one-at-a-time queries.
+		return [run_query(model_path, prompt_format, prompt, [], completion_tokens, model, tokenizer, temp,
+						inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client, api_key)
+						for prompt in prompts]
+	else:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(prompts), BATCH_QUERY_MAX_THREADS)) as executor:
+			futures = [executor.submit(run_query, model_path, prompt_format, prompt, [], completion_tokens,
+								model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba,
+								ooba_request_timeout, openai_client, api_key) for prompt in prompts]
+			return [future.result() for future in futures]
+
 def run_query(model_path, prompt_format, prompt, history, completion_tokens, model, tokenizer, temp, inference_engine, ooba_instance, launch_ooba, ooba_request_timeout, openai_client, api_key = None):
 	if inference_engine == 'llama.cpp':
 		return run_llamacpp_query(prompt, prompt_format, completion_tokens, temp)
+	elif inference_engine == 'vllm':
+		return run_vllm_query([prompt], prompt_format, completion_tokens, temp, model_path)[0]
 	elif inference_engine == 'openai':
 		return run_openai_query(prompt, history, completion_tokens, temp, model_path, openai_client)
 	elif inference_engine == 'anthropic':
@@ -1,6 +1,17 @@
 import re
-import json
 import math
+import numpy as np
+from lib.util import save_results
+
+# Precompiled patterns for parsing emotion intensity ratings. These run once
+# per inference (including retries), so compiling them up front keeps the
+# regex work out of the hot loop.
+ANSWER_PATTERN = re.compile(r'(\w+):\s+(\d+)')
+FIRST_PASS_SECTION_PATTERN = re.compile(r'First pass scores:(.*?)Revised scores:', re.DOTALL)
+REVISED_SECTION_PATTERN = re.compile(r'Revised scores:(.*?)$', re.DOTALL)
+ANSWER_PATTERN_DE = re.compile(r'([a-zA-ZäöüßÄÖÜ\s]+):\s*\**(\d+(?:,\d+)?)\**')
+FIRST_PASS_SECTION_PATTERN_DE = re.compile(r'(Erste.*?):\s*(.*?)(?=Überarbeitete|$)', re.IGNORECASE | re.DOTALL)
+REVISED_SECTION_PATTERN_DE = re.compile(r'(Überarbeitete.*?):\s*(.*)', re.IGNORECASE | re.DOTALL)
 
 # Parse the emotion intensity ratings from the raw inference text
 def parse_answers(text, REVISE):
@@ -9,18 +20,18 @@ def parse_answers(text, REVISE):
 
 	# Extracting first pass answers
 	if REVISE:
-		first_pass_match = re.search(r'First pass scores:(.*?)Revised scores:', text, re.DOTALL)
+		first_pass_match = FIRST_PASS_SECTION_PATTERN.search(text)
 		if first_pass_match:
 			first_pass_text = first_pass_match.group(1)
-			first_pass_answers = dict(re.findall(r'(\w+):\s+(\d+)', first_pass_text))
+			first_pass_answers = dict(ANSWER_PATTERN.findall(first_pass_text))
 
 		# Extracting revised answers
-		revised_match = re.search(r'Revised scores:(.*?)$', text, re.DOTALL)
+		revised_match = REVISED_SECTION_PATTERN.search(text)
 		if revised_match:
 			revised_text = revised_match.group(1)
-			revised_answers = dict(re.findall(r'(\w+):\s+(\d+)', revised_text))
+			revised_answers = dict(ANSWER_PATTERN.findall(revised_text))
 	else:
-		first_pass_answers = dict(re.findall(r'(\w+):\s+(\d+)', text))
+		first_pass_answers = dict(ANSWER_PATTERN.findall(text))
 		revised_answers = {}
 
 	return first_pass_answers, revised_answers
@@ -31,23 +42,20 @@ def parse_answers_de(text, REVISE):
     first_pass_answers = {}
     revised_answers = {}
 
-    first_pass_heading_pattern = r'(Erste.*?):\s*(.*?)(?=Überarbeitete|$)'
-    revised_heading_pattern = r'(Überarbeitete.*?):\s*(.*)'
-    
     if REVISE:
-        first_pass_match = re.search(first_pass_heading_pattern, text, re.IGNORECASE | re.DOTALL)
+        first_pass_match = FIRST_PASS_SECTION_PATTERN_DE.search(text)
         if first_pass_match:
             first_pass_text = first_pass_match.group(2)
-            pairs = re.findall(r'([a-zA-ZäöüßÄÖÜ\s]+):\s*\**(\d+(?:,\d+)?)\**', first_pass_text)
+            pairs = ANSWER_PATTERN_DE.findall(first_pass_text)
             first_pass_answers = {label.strip(): score.replace('*', '') for label, score in pairs}
 
-        revised_match = re.search(revised_heading_pattern, text, re.IGNORECASE | re.DOTALL)
+        revised_match = REVISED_SECTION_PATTERN_DE.search(text)
         if revised_match:
             revised_text = revised_match.group(2)
-            pairs = re.findall(r'([a-zA-ZäöüßÄÖÜ\s]+):\s*\**(\d+(?:,\d+)?)\**', revised_text)
+            pairs = ANSWER_PATTERN_DE.findall(revised_text)
             revised_answers = {label.strip(): score.replace('*', '') for label, score in pairs}
     else:
-        pairs = re.findall(r'([a-zA-ZäöüßÄÖÜ\s]+):\s*\**(\d+(?:,\d+)?)\**', text)
+        pairs = ANSWER_PATTERN_DE.findall(text)
         first_pass_answers = {label.strip(): score.replace('*', '') for label, score in pairs}
         revised_answers = {}
 
@@ -60,44 +68,98 @@ def calculate_score_fullscale(reference, user):
 		#print('! Error: 4 emotions were not returned')
 		#print(user)
 		return None
-	emotions_dict = {}
-	for emotion, user_emotion_score in user.items():
-		for i in range(1, 5):
-			if emotion.lower() == reference[f'emotion{i}'].lower():
-				emotions_dict[emotion.lower()] = True
-	if len(emotions_dict) != 4:
+	ref_scores = {reference[f'emotion{i}'].lower(): float(reference[f'emotion{i}_score']) for i in range(1, 5)}
+	user_scores = {emotion.lower(): user_emotion_score for emotion, user_emotion_score in user.items()}
+	if len(user_scores) != 4 or set(user_scores) != set(ref_scores):
 		print('! Error: emotions did not match reference')
 		print(user)
 		return None
-	
-	difference_tally = 0  # Tally of differerence from reference answers for this question
-	
-	# Iterate over each emotion in the user's answers.
-	for emotion, user_emotion_score in user.items():
-		# If this emotion is in the reference, calculate the difference between the user's score and the reference score.
-		for i in range(1, 5):
-			if emotion.lower() == reference[f'emotion{i}'].lower():
-				d = abs(float(user_emotion_score) - float(reference[f'emotion{i}_score']))
-				# this will be a value between 0 and 10
-				if d == 0:
-					scaled_difference = 0
-				elif d <= 5:
-					# S-shaped scaling function
-					# https://www.desmos.com/calculator
-					# 6.5\cdot\ \frac{1}{\left(1\ +\ e^{\left(-1.2\cdot\left(x-4\right)\right)}\right)}						
-					scaled_difference = 6.5 * (1 / (1 + math.e ** (-1.2 * (d-4))))
-
-				else:
-					scaled_difference = d
-				difference_tally += scaled_difference
-					
+
+	# Compute the differences from the reference scores for all four emotions at once.
+	emotions = list(user_scores)
+	d = np.abs(np.array([float(user_scores[emotion]) for emotion in emotions])
+				- np.array([ref_scores[emotion] for emotion in emotions]))
+	# Differences (each a value between 0 and 10) up to 5 are scaled with an
+	# S-shaped function; larger differences are counted as-is.
+	# https://www.desmos.com/calculator
+	# 6.5\cdot\ \frac{1}{\left(1\ +\ e^{\left(-1.2\cdot\left(x-4\right)\right)}\right)}
+	scaled = np.where(d == 0, 0.0, np.where(d <= 5, 6.5 * (1 / (1 + math.e ** (-1.2 * (d-4)))), d))
+	difference_tally = float(scaled.sum())
+
 	# Inverting the difference tally so that the closer the answer is to reference, the higher the score.
 	# The adjustment constant is chosen such that answering randomly produces a score of zero.
 	adjust_const =  0.7477
 	final_score = 10 - (difference_tally * adjust_const)
-	
+
 	return final_score
 
+# Fused per-question scoring: walks each answer dict once and scores it against
+# both the v1 reference and the fullscale reference, instead of re-traversing
+# the same dicts in separate calculate_score / calculate_score_fullscale calls.
+# Returns (this_result, this_result_fullscale) in the same shape the results
+# dict stores, with scores set to None wherever validation fails (identical
+# semantics to the separate calls).
+def calculate_all_scores(reference, reference_fullscale, first_pass_answers, revised_answers, REVISE):
+	first_pass_score, first_pass_score_fullscale = _score_answers_fused(reference, reference_fullscale, first_pass_answers)
+	if REVISE:
+		revised_score, revised_score_fullscale = _score_answers_fused(reference, reference_fullscale, revised_answers)
+	else:
+		revised_score = None
+		revised_score_fullscale = None
+
+	this_result = {
+		'first_pass_score': first_pass_score,
+		'revised_score': revised_score
+	}
+	this_result_fullscale = {
+		'first_pass_score': first_pass_score_fullscale,
+		'revised_score': revised_score_fullscale
+	}
+	return this_result, this_result_fullscale
+
+# Score one answer dict against both references in a single pass.
+# Returns (v1_score, fullscale_score); either is None if its validation fails.
+def _score_answers_fused(reference, reference_fullscale, user):
+	if len(user.items()) != 4:
+		print('! Error: 4 emotions were not returned')
+		print(user)
+		return None, None
+
+	ref_lower = {reference[f'emotion{i}'].lower() for i in range(1, 5)}
+	# v1 matches the reference score case-sensitively; fullscale matches case-insensitively.
+	ref_exact_scores = {reference[f'emotion{i}']: float(reference[f'emotion{i}_score']) for i in range(1, 5)}
+
+	matched = 0
+	total_user_score = 0.0
+	for emotion, user_emotion_score in user.items():
+		total_user_score += float(user_emotion_score)
+		if emotion.lower() in ref_lower:
+			matched += 1
+
+	# v1 (normalised) score
+	if matched != 4:
+		print('! Error: emotions did not match reference')
+		print(user)
+		v1_score = None
+	elif total_user_score <= 0:
+		print('Error: total of scores must be > 0')
+		print(user)
+		v1_score = None
+	else:
+		difference_tally = 0
+		for emotion, user_emotion_score in user.items():
+			if emotion in ref_exact_scores:
+				difference_tally += abs(float(user_emotion_score) / total_user_score * 10 - ref_exact_scores[emotion])
+		v1_score = 10 - difference_tally
+
+	# Fullscale (v2) score
+	if reference_fullscale:
+		fullscale_score = calculate_score_fullscale(reference_fullscale, user)
+	else:
+		fullscale_score = None
+
+	return v1_score, fullscale_score
+
 # Calculate the score for an individual question (Legacy v1 scoring)
 def calculate_score(reference, user):
 	# First check that the emotions specified in the answer match those in the reference
@@ -214,8 +276,7 @@ def calculate_eq_bench_score(run_index, results, results_path, fullscale=False):
 	else:
 		averaged_score = round(averaged_score, 2)
 
-	with open(results_path, 'w') as f:
-		json.dump(results, f)
+	save_results(results, results_path, force=True)
 
 	return (averaged_score, round(parseable_tally / n_iterations, 2))
 
@@ -2,9 +2,162 @@ import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import re
 import os
+import json
+import time
+import atexit
+import functools
+import random
 import psutil
 import shutil
 
+try:
+	# orjson serializes/parses several times faster than stdlib json, which
+	# matters for the large raw results dict. Optional; stdlib json is used
+	# when it isn't installed.
+	import orjson
+except ImportError:
+	orjson = None
+
+FLUSH_INTERVAL_S = 10 # Max seconds between raw results flushes
+FLUSH_EVERY_N = 16 # ... or flush after this many deferred saves, whichever comes first
+
+# Module state for save_results throttling
+_last_flush = 0.0
+_dirty_count = 0
+_pending_save = None # (results, path) of the most recent deferred save
+
+def _write_results_atomic(results, path):
+	# Write to a temp file and move it into place so a crash mid-write can't
+	# corrupt the results file.
+	tmp_path = path + '.tmp'
+	if orjson:
+		# OPT_SERIALIZE_NUMPY: judgemark stores numpy scalars (np.mean/np.std
+		# outputs) in the results dict, which stdlib json accepts but orjson
+		# rejects by default.
+		with open(tmp_path, 'wb') as f:
+			f.write(orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY))
+	else:
+		with open(tmp_path, 'w') as f:
+			json.dump(results, f)
+	os.replace(tmp_path, path)
+
+def load_json_file(path):
+	if orjson:
+		with open(path, 'rb') as f:
+			return orjson.loads(f.read())
+	with open(path, 'r') as f:
+		return json.load(f)
+
+@functools.lru_cache(maxsize=None)
+def load_json_file_cached(path):
+	"""
+	Cached loader for the static question/prompt files, which otherwise get
+	re-read and re-parsed for every benchmark run in a batch sweep. The
+	cached dict is shared between runs, so callers must not mutate it.
+	"""
+	return load_json_file(path)
+
+def save_results(results, path, force=False):
+	"""
+	Save the results dict to disk, throttled to at most one write every
+	FLUSH_INTERVAL_S seconds (or every FLUSH_EVERY_N deferred saves).
+	Serializing the whole results dict after every single question is
+	expensive on large runs; deferred saves are flushed at exit and can be
+	forced at important checkpoints with force=True.
+	"""
+	global _last_flush, _dirty_count, _pending_save
+	_pending_save = (results, path)
+	_dirty_count += 1
+	if not force and _dirty_count < FLUSH_EVERY_N and time.monotonic() - _last_flush < FLUSH_INTERVAL_S:
+		return
+	_write_results_atomic(results, path)
+	_last_flush = time.monotonic()
+	_dirty_count = 0
+	_pending_save = None
+
+def _flush_pending_results():
+	if _pending_save:
+		_write_results_atomic(*_pending_save)
+
+atexit.register(_flush_pending_results)
+
+class ResultsStore:
+	"""
+	Flat store of individual score rows, mirroring the nested results dict in
+	a columnar layout (run_index, iteration, item_id, kind, value). Upserting
+	a row is O(1) and the whole table exports in one shot to parquet (when
+	pyarrow is installed) or newline-delimited json otherwise, instead of
+	re-serializing the nested tree. The legacy raw_results.json remains the
+	source of truth for scoring and resume; this is a cheap structured export
+	for downstream analysis.
+	"""
+	def __init__(self, export_path='./raw_results_flat'):
+		self.export_path = export_path
+		self.rows = []
+		self.index = {} # (run_index, iteration, item_id, kind) -> position in rows
+
+	def upsert(self, run_index, run_iter, item_id, kind, value):
+		if value is None:
+			return
+		key = (run_index, run_iter, item_id, kind)
+		row = {
+			'run_index': run_index,
+			'iteration': run_iter,
+			'item_id': item_id,
+			'kind': kind,
+			'value': float(value)
+		}
+		# Replace the existing row for this key (e.g. a question re-scored on
+		# a retry) instead of appending a duplicate.
+		if key in self.index:
+			self.rows[self.index[key]] = row
+		else:
+			self.index[key] = len(self.rows)
+			self.rows.append(row)
+
+	def export(self):
+		if not self.rows:
+			return
+		try:
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+			table = pa.Table.from_pylist(self.rows)
+			pq.write_table(table, self.export_path + '.parquet', compression='zstd')
+		except ImportError:
+			with open(self.export_path + '.jsonl', 'w') as f:
+				for row in self.rows:
+					f.write(json.dumps(row) + '\n')
+		except Exception as e:
+			print('! Failed to export flat results:', e)
+
+results_store = ResultsStore()
+
+def retry_backoff_sleep(attempt, initial=0.1, max_delay=2.0):
+	"""
+	Sleep for an exponentially increasing delay with random jitter before the
+	next retry attempt (attempt numbering starts at 1). The jitter spreads
+	concurrent retries out so parallel workers don't hammer a struggling
+	endpoint in lockstep.
+	"""
+	delay = min(initial * (2 ** (attempt - 1)), max_delay)
+	time.sleep(random.uniform(0, delay))
+
+def gpu_cleanup():
+	"""
+	Release cached gpu memory held by finished sequences (KV-cache,
+	intermediate activations) so long multi-iteration runs don't slowly
+	fragment vram. empty_cache() syncs the device (~tens of ms), so call
+	this between batches or iterations, not per question.
+	"""
+	import gc
+	gc.collect()
+	try:
+		import torch
+		if torch.cuda.is_available():
+			torch.cuda.empty_cache()
+	except ImportError:
+		pass
+
 QUANT_TYPES = [
 	'8bit',
 	'4bit',
@@ -108,8 +261,8 @@ def parse_batch(batch, ooba_launch_script, launch_ooba):
 			
 			# Read inference engine option from config
 			inference_engine = inference_engine.strip().lower()
-			if inference_engine not in ['transformers', 'ooba', 'openai', 'llama.cpp', 'anthropic', 'mistralai', 'gemini']:
-				raise Exception("inference_engine in config.cfg must be transformers, openai, oobabooga or llama.cpp.")
+			if inference_engine not in ['transformers', 'vllm', 'ooba', 'openai', 'llama.cpp', 'anthropic', 'mistralai', 'gemini']:
+				raise Exception("inference_engine in config.cfg must be transformers, vllm, openai, oobabooga or llama.cpp.")
 			if inference_engine == 'ooba' and not ooba_launch_script:
 				raise Exception('ooba_launch_script not set in config.cfg')
 			